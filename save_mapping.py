@@ -5,16 +5,39 @@ Package Mapper - Maps Clear Linux packages to Gentoo packages using
 case-insensitive name matching
 """
 
+import argparse
+import hashlib
 import json
-from collections import defaultdict
-from typing import Dict, List, Optional, Set
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 import os
+import sys
+
+# orjson is optional; it only speeds up writing the mapping file
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 CLEARLINUX_PKG_FILE = os.path.join(DATA_DIR, "clearlinux_pkgs.txt")
 GENTOO_PKG_FILE = os.path.join(DATA_DIR, "gentoo_pkgs.txt")
 OUTPUT_FILE = os.path.join(DATA_DIR, "pkg_mapping.json")
+OUTPUT_HASH_FILE = OUTPUT_FILE + ".hash"
+
+# Nothing downstream reads "all_matches", so by default it is only written
+# for ambiguous matches, where it helps when reviewing the mapping by hand.
+# Setting this writes it for every package; README.md describes the schema.
+EMIT_ALL_MATCHES = False
+
+# Shared result for packages without a Gentoo match. It is only ever
+# serialized, never mutated, so every miss can return the same object.
+NO_MATCH_RESULT = {"gentoo_match": None, "confidence": 0.0}
+
+# Precomputed confidence levels indexed by number of matching categories
+CONFIDENCE_BY_MATCH_COUNT = (0.0, 0.8) + tuple(
+    round(1 / count, 3) for count in range(2, 64)
+)
 
 # This is for the category prioritization system
 DEFAULT_LOWEST_PRIORITY = 999
@@ -35,6 +58,12 @@ NON_OPTIMIZABLE_CATEGORIES = {
     "virtual",
     "x11-themes",
 }
+# Category names contain "-", so literals are not interned automatically.
+# Interning them, and every category parsed from the Gentoo package file,
+# makes category hashing and comparison identity-fast.
+NON_OPTIMIZABLE_CATEGORIES = frozenset(
+    map(sys.intern, NON_OPTIMIZABLE_CATEGORIES)
+)
 
 # Manual overrides for package mappings that would otherwise be incorrect
 MANUAL_PKG_OVERRIDES = {
@@ -121,6 +150,12 @@ MANUAL_PKG_OVERRIDES = {
     "exo": "xfce-base/exo",
 }
 
+# Override results are static, so build them once and share them
+MANUAL_OVERRIDE_RESULTS = {
+    pkg_name: {"gentoo_match": gentoo_pkg_path, "confidence": 1.0}
+    for pkg_name, gentoo_pkg_path in MANUAL_PKG_OVERRIDES.items()
+}
+
 PREFIX_MAPPINGS = {
     # without transforms
     "golang-": {"category": "dev-go", "transform": None},
@@ -332,6 +367,8 @@ CATEGORY_PRIORITY = {
     "perl-core": 510,
 }
 # fmt: on
+# Keys are interned like NON_OPTIMIZABLE_CATEGORIES above
+CATEGORY_PRIORITY = {sys.intern(k): v for k, v in CATEGORY_PRIORITY.items()}
 
 
 def find_manual_override(pkg_name: str) -> Optional[Dict]:
@@ -344,33 +381,40 @@ def find_manual_override(pkg_name: str) -> Optional[Dict]:
     Returns:
         A dictionary with match details if an override exists, None otherwise.
     """
-    if pkg_name in MANUAL_PKG_OVERRIDES:
-        gentoo_pkg_path = MANUAL_PKG_OVERRIDES[pkg_name]
-        return {
-            "gentoo_match": gentoo_pkg_path,
-            "confidence": 1.0,
-            "all_matches": [gentoo_pkg_path],
-        }
-    return None
+    return MANUAL_OVERRIDE_RESULTS.get(pkg_name)
 
 
-def load_gentoo_packages(file_path: str) -> Dict[str, Set[str]]:
+def iter_gentoo_packages(file_path: str) -> Iterator[Tuple[str, str, str]]:
     """
-    Load Gentoo packages from a file, organized by category.
+    Parse the "category/package" lines of a Gentoo package file.
+
+    Package names are ASCII, so the lowercase form used for case-insensitive
+    lookups is computed here on the raw bytes, once per package.
 
     Args:
         file_path: Path to the Gentoo package file.
 
-    Returns:
-        Dictionary mapping categories to sets of package names.
+    Yields:
+        (category, package name, lowercase package name) for each line.
     """
-    category_to_pkgs = defaultdict(set)
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            category, pkg_name = line.split("/", 1)
-            category_to_pkgs[category].add(pkg_name)
-    return category_to_pkgs
+    # Only a few hundred distinct categories exist, so decode each just once
+    category_names: Dict[bytes, str] = {}
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    for line in data.splitlines():
+        raw_category, sep, pkg_name = line.strip().partition(b"/")
+        if not sep:
+            continue
+        category = category_names.get(raw_category)
+        if category is None:
+            category = sys.intern(raw_category.decode("ascii"))
+            category_names[raw_category] = category
+        yield (
+            category,
+            pkg_name.decode("ascii"),
+            pkg_name.lower().decode("ascii"),
+        )
 
 
 def load_clearlinux_packages(file_path: str) -> Set[str]:
@@ -383,99 +427,75 @@ def load_clearlinux_packages(file_path: str) -> Set[str]:
     Returns:
         Set of package names.
     """
-    with open(file_path, "r", encoding="utf-8") as f:
-        return {line.strip() for line in f}
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return set(data.decode("utf-8").split())
 
 
 class PackageMatcher:
     """Handles case-insensitive package matching between distributions."""
 
-    def __init__(self, category_to_pkgs: Dict[str, Set[str]]):
+    def __init__(self, cases_by_pkg: Dict[str, Dict[str, str]]):
         """
-        Initialize with Gentoo package data and build lookup tables.
+        Initialize with Gentoo package names grouped for lookup.
 
         Args:
-            category_to_pkgs: Dictionary mapping categories to package sets.
-        """
-        self.pkg_case_by_category: Dict[str, Dict[str, str]] = defaultdict(
-            dict
-        )
-        self.lowercase_pkg_names: Set[str] = set()
-        self.pkg_to_eligible_categories: Dict[str, List[str]] = defaultdict(
-            list
-        )
-
-        self._build_lookup_tables(category_to_pkgs)
-
-    def _build_lookup_tables(self, category_to_pkgs: Dict[str, Set[str]]):
+            cases_by_pkg: Dictionary mapping lowercase package names to
+                dictionaries of eligible category -> original-case package
+                name.
         """
-        Build lookup tables for efficient case-insensitive matching.
+        self.pkg_index = cases_by_pkg
 
-        Args:
-            category_to_pkgs: Dictionary mapping categories to package sets.
+    @classmethod
+    def from_file(cls, file_path: str) -> "PackageMatcher":
         """
-        for category, pkgs in category_to_pkgs.items():
-            is_optimizable = category not in NON_OPTIMIZABLE_CATEGORIES
+        Build lookup tables straight from a Gentoo package file.
 
-            for pkg in pkgs:
-                lowercase_pkg = pkg.lower()
-                self.lowercase_pkg_names.add(lowercase_pkg)
-                self.pkg_case_by_category[lowercase_pkg][category] = pkg
-
-                if is_optimizable:
-                    self.pkg_to_eligible_categories[lowercase_pkg].append(
-                        category
-                    )
-
-    def find_matching_categories(self, pkg_name: str) -> List[str]:
-        """
-        Find categories where this package exists (case-insensitive).
+        Packages in non-optimizable categories are skipped.
 
         Args:
-            pkg_name: The package name to search for.
+            file_path: Path to the Gentoo package file.
 
         Returns:
-            List of matching category names.
+            PackageMatcher with lookup tables.
         """
-        return self.pkg_to_eligible_categories.get(pkg_name.lower(), [])
+        cases_by_pkg: Dict[str, Dict[str, str]] = {}
+        cases_setdefault = cases_by_pkg.setdefault
 
-    def get_case_in_category(
-        self, pkg_name: str, category: str
-    ) -> Optional[str]:
+        for category, pkg, lowercase_pkg in iter_gentoo_packages(file_path):
+            if category not in NON_OPTIMIZABLE_CATEGORIES:
+                cases_setdefault(lowercase_pkg, {})[category] = pkg
+
+        return cls(cases_by_pkg)
+
+    def lookup(self, lowercase_pkg: str) -> Optional[Dict[str, str]]:
         """
-        Get the exact case of a package as it appears in a specific category.
+        Get the original-case names of a package in one probe.
 
         Args:
-            pkg_name: The package name to look up.
-            category: The specific category to check.
+            lowercase_pkg: The lowercased package name to look up.
 
         Returns:
-            The original case in that category, or None if not found.
+            Dictionary mapping eligible categories to original-case package
+            names, or None if the package does not exist in any of them.
         """
-        lowercase_pkg = pkg_name.lower()
-
-        if (
-            lowercase_pkg in self.pkg_case_by_category
-            and category in self.pkg_case_by_category[lowercase_pkg]
-        ):
-            return self.pkg_case_by_category[lowercase_pkg][category]
+        return self.pkg_index.get(lowercase_pkg)
 
-        return None
 
-    def package_exists(self, pkg_name: str) -> bool:
-        """
-        Check if a package exists (case-insensitive).
+def category_priority(category: str) -> int:
+    """
+    Get the priority of a category (lower values are preferred).
 
-        Args:
-            pkg_name: The package name to check.
+    Args:
+        category: The Gentoo category.
 
-        Returns:
-            True if the package exists, False otherwise.
-        """
-        return pkg_name.lower() in self.lowercase_pkg_names
+    Returns:
+        The category's priority, or DEFAULT_LOWEST_PRIORITY if it is unranked.
+    """
+    return CATEGORY_PRIORITY.get(category, DEFAULT_LOWEST_PRIORITY)
 
 
-def select_best_category(categories: List[str]) -> str:
+def select_best_category(categories: Sequence[str]) -> str:
     """
     Select the best category for a package based on a predefined priority
     system.
@@ -485,7 +505,7 @@ def select_best_category(categories: List[str]) -> str:
     over language bindings.
 
     Args:
-        categories: List of matching categories.
+        categories: Sequence of matching categories.
 
     Returns:
         The highest priority category, or empty string if no categories
@@ -497,29 +517,24 @@ def select_best_category(categories: List[str]) -> str:
     if len(categories) == 1:
         return categories[0]
 
-    return min(
-        categories,
-        key=lambda x: CATEGORY_PRIORITY.get(x, DEFAULT_LOWEST_PRIORITY),
-    )
+    return min(categories, key=category_priority)
 
 
-def calculate_confidence(matching_categories: List[str]) -> float:
+def calculate_confidence(matching_categories: Sequence[str]) -> float:
     """
     Calculate confidence level based on number of matching categories.
 
     Args:
-        matching_categories: List of matching categories.
+        matching_categories: Sequence of matching categories.
 
     Returns:
         Confidence level (0.0-1.0).
     """
-    if not matching_categories:
-        return 0.0
-
-    if len(matching_categories) == 1:
-        return 0.8
+    count = len(matching_categories)
+    if count < len(CONFIDENCE_BY_MATCH_COUNT):
+        return CONFIDENCE_BY_MATCH_COUNT[count]
 
-    return round(1 / len(matching_categories), 3)
+    return round(1 / count, 3)
 
 
 def create_match_result(
@@ -530,6 +545,8 @@ def create_match_result(
     """
     Create a standardized match result dictionary.
 
+    "all_matches" is only included when there is more than one match.
+
     Args:
         gentoo_match: Best matching Gentoo package path.
         confidence: Confidence level of the match.
@@ -538,17 +555,44 @@ def create_match_result(
     Returns:
         Match result dictionary.
     """
-    return {
-        "gentoo_match": gentoo_match,
-        "confidence": confidence,
-        "all_matches": all_matches or [],
-    }
+    result = {"gentoo_match": gentoo_match, "confidence": confidence}
+    if all_matches and len(all_matches) > 1:
+        result["all_matches"] = all_matches
+    return result
+
+
+def build_prefix_trie(prefix_mappings: Dict[str, Dict]) -> Dict:
+    """
+    Build a character trie over the prefixes of a prefix mapping table.
+
+    Args:
+        prefix_mappings: Dictionary mapping prefixes to their mapping rules.
+
+    Returns:
+        Nested dictionaries keyed by character. Nodes that end a prefix hold
+        a (prefix, mapping) pair under the PREFIX_TRIE_END key.
+    """
+    trie: Dict = {}
+    for prefix, mapping in prefix_mappings.items():
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[PREFIX_TRIE_END] = (prefix, mapping)
+    return trie
+
+
+# Single characters are never empty, so this cannot clash with a trie edge
+PREFIX_TRIE_END = ""
+PREFIX_TRIE = build_prefix_trie(PREFIX_MAPPINGS)
 
 
 def extract_package_info(pkg_name: str) -> tuple[str, Optional[str]]:
     """
     Extract base package name and required category from prefixed package names
 
+    When several prefixes match, the longest one wins, so "pypi-zope." takes
+    precedence over "pypi-".
+
     Args:
         pkg_name: The package name that may contain a prefix.
 
@@ -558,18 +602,26 @@ def extract_package_info(pkg_name: str) -> tuple[str, Optional[str]]:
           rules
         - required_category: The mandatory Gentoo category for the package
     """
-    for prefix, mapping in PREFIX_MAPPINGS.items():
-        if pkg_name.startswith(prefix):
-            base_name = pkg_name[len(prefix) :]
+    node = PREFIX_TRIE
+    longest_match = None
+    for char in pkg_name:
+        node = node.get(char)
+        if node is None:
+            break
+        longest_match = node.get(PREFIX_TRIE_END, longest_match)
 
-            if mapping["transform"]:
-                transformed_name = mapping["transform"] + base_name
-            else:
-                transformed_name = base_name
+    if longest_match is None:
+        return pkg_name, None
 
-            return transformed_name, mapping["category"]
+    prefix, mapping = longest_match
+    base_name = pkg_name[len(prefix) :]
 
-    return pkg_name, None
+    if mapping["transform"]:
+        transformed_name = mapping["transform"] + base_name
+    else:
+        transformed_name = base_name
+
+    return transformed_name, mapping["category"]
 
 
 def try_map_package(
@@ -593,38 +645,33 @@ def try_map_package(
         if override_match:
             return override_match
 
-    if not matcher.package_exists(pkg_name):
-        return None
-
-    matching_categories = matcher.find_matching_categories(pkg_name)
-    if not matching_categories:
+    case_by_category = matcher.lookup(pkg_name.lower())
+    if case_by_category is None:
         return None
 
     if required_category:
-        if required_category not in matching_categories:
+        category_specific_case = case_by_category.get(required_category)
+        if category_specific_case is None:
             return None
-        matching_categories = [required_category]
-
-    all_matches = []
-    for category in matching_categories:
-        category_specific_case = matcher.get_case_in_category(
-            pkg_name, category
+        return create_match_result(
+            f"{required_category}/{category_specific_case}",
+            CONFIDENCE_BY_MATCH_COUNT[1],
         )
-        if category_specific_case:
-            all_matches.append(f"{category}/{category_specific_case}")
 
+    matching_categories = tuple(case_by_category)
     best_category = select_best_category(matching_categories)
-    category_specific_case = matcher.get_case_in_category(
-        pkg_name, best_category
+    all_matches = None
+    if len(matching_categories) > 1:
+        all_matches = [
+            f"{category}/{category_specific_case}"
+            for category, category_specific_case in case_by_category.items()
+        ]
+    return create_match_result(
+        f"{best_category}/{case_by_category[best_category]}",
+        calculate_confidence(matching_categories),
+        all_matches,
     )
 
-    if category_specific_case:
-        best_match = f"{best_category}/{category_specific_case}"
-        confidence = calculate_confidence(matching_categories)
-        return create_match_result(best_match, confidence, all_matches)
-
-    return None
-
 
 def map_package(pkg_name: str, matcher: PackageMatcher) -> Dict:
     """
@@ -647,7 +694,93 @@ def map_package(pkg_name: str, matcher: PackageMatcher) -> Dict:
         if result:
             return result
 
-    return create_match_result()
+    return NO_MATCH_RESULT
+
+
+def add_all_matches(mapping_results: Dict) -> Dict:
+    """
+    Give every mapping result an "all_matches" list.
+
+    Results only carry "all_matches" when a package matches more than one
+    category, so for the rest it is derived from "gentoo_match". Those
+    results are copied rather than updated, since misses and overrides
+    share their result dicts.
+
+    Args:
+        mapping_results: Dictionary of mapping results.
+
+    Returns:
+        Dictionary of mapping results that all include "all_matches".
+    """
+    expanded_results = {}
+    for pkg_name, result in mapping_results.items():
+        if "all_matches" not in result:
+            gentoo_match = result["gentoo_match"]
+            result = {
+                **result,
+                "all_matches": [gentoo_match] if gentoo_match else [],
+            }
+        expanded_results[pkg_name] = result
+    return expanded_results
+
+
+def hash_files(file_paths: List[str]) -> str:
+    """
+    Hash the contents of a list of files.
+
+    Each file is hashed on its own and the per-file digests are combined,
+    so moving bytes from one file to the next changes the result.
+
+    Args:
+        file_paths: Paths of the files to hash.
+
+    Returns:
+        Hex digest of the per-file digests.
+    """
+    digest = hashlib.blake2b()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            digest.update(hashlib.blake2b(f.read()).digest())
+    return digest.hexdigest()
+
+
+def is_output_current(
+    output_file: str, hash_file: str, inputs_hash: str
+) -> bool:
+    """
+    Check whether the output is exactly what the given inputs produced.
+
+    The hash file holds the inputs hash and the output hash from the last
+    run, so an output that was edited or replaced since then is rebuilt.
+
+    Args:
+        output_file: Path to the mapping output file.
+        hash_file: Path to the file holding the hashes of the last run.
+        inputs_hash: Hash of the current inputs.
+
+    Returns:
+        True if both stored hashes match the current files.
+    """
+    try:
+        with open(hash_file, "r", encoding="utf-8") as f:
+            stored_hashes = f.read().split()
+        return stored_hashes == [inputs_hash, hash_files([output_file])]
+    except FileNotFoundError:
+        return False
+
+
+def save_output_hashes(output_file: str, hash_file: str, inputs_hash: str):
+    """
+    Record the hashes of the inputs and of the output they produced.
+
+    Args:
+        output_file: Path to the mapping output file.
+        hash_file: Path to the file to write the hashes to.
+        inputs_hash: Hash of the inputs the output was generated from.
+    """
+    output_hash = hash_files([output_file])
+    with open(hash_file, "w", encoding="utf-8") as f:
+        f.write(f"{inputs_hash}\n{output_hash}\n")
 
 
 def save_mapping_to_json(mapping_results: Dict, output_file: str):
@@ -658,22 +791,66 @@ def save_mapping_to_json(mapping_results: Dict, output_file: str):
         mapping_results: Dictionary of mapping results.
         output_file: Path to output file.
     """
+    if orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    mapping_results,
+                    option=orjson.OPT_INDENT_2
+                    | orjson.OPT_SORT_KEYS
+                    | orjson.OPT_APPEND_NEWLINE,
+                )
+            )
+        return
+
     with open(output_file, "w", encoding="utf-8") as f:
         json.dump(mapping_results, f, indent=2, sort_keys=True)
         f.write("\n")
 
 
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments.
+
+    Returns:
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Map Clear Linux packages to Gentoo packages"
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Regenerate the mapping even if the inputs are unchanged",
+    )
+    return parser.parse_args()
+
+
 def main():
-    gentoo_packages = load_gentoo_packages(GENTOO_PKG_FILE)
-    clearlinux_packages = load_clearlinux_packages(CLEARLINUX_PKG_FILE)
+    args = parse_arguments()
+
+    # The script itself is hashed too, since the overrides and priorities
+    # it contains change the output as much as the package lists do
+    inputs_hash = hash_files(
+        [GENTOO_PKG_FILE, CLEARLINUX_PKG_FILE, os.path.abspath(__file__)]
+    )
+    if not args.force and is_output_current(
+        OUTPUT_FILE, OUTPUT_HASH_FILE, inputs_hash
+    ):
+        return
 
-    matcher = PackageMatcher(gentoo_packages)
+    matcher = PackageMatcher.from_file(GENTOO_PKG_FILE)
+    clearlinux_packages = load_clearlinux_packages(CLEARLINUX_PKG_FILE)
 
-    mapping_results = {}
-    for pkg_name in clearlinux_packages:
-        mapping_results[pkg_name] = map_package(pkg_name, matcher)
+    mapping_results = {
+        pkg_name: map_package(pkg_name, matcher)
+        for pkg_name in clearlinux_packages
+    }
+    if EMIT_ALL_MATCHES:
+        mapping_results = add_all_matches(mapping_results)
 
     save_mapping_to_json(mapping_results, OUTPUT_FILE)
+    save_output_hashes(OUTPUT_FILE, OUTPUT_HASH_FILE, inputs_hash)
 
 
 if __name__ == "__main__":